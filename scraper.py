@@ -1,22 +1,33 @@
 """
 Ejemplo de scraper en Python para einforma.com (autónomos)
-Usa requests + BeautifulSoup con lógica de reintentos para recorrer automáticamente
-la paginación y extraer nombre, CIF, Número D-U-N-S, CNAE, Domicilio Social y Forma Jurídica.
-Exporta a Excel o CSV como fallback.
-Configura `delay` y `max_pages` en `INPUT.json`.
+Usa aiohttp + lxml con lógica de reintentos para recorrer
+la paginación y extraer nombre, CIF, Número D-U-N-S, CNAE, Domicilio Social
+y Forma Jurídica. Paginación y fichas forman un pipeline productor/
+consumidor sobre la RequestQueue de Apify (deduplicación por unique_key
+y persistencia entre ejecuciones): los workers de detalle arrancan en
+cuanto llegan los IDs de la primera página, compartiendo el pool de
+conexiones; la extracción de campos usa XPaths compilados una sola vez
+a nivel de módulo. Los registros se envían también al dataset del actor.
+Exporta a Parquet (pyarrow, compresión zstd, en partes rotadas por
+checkpoint) o CSV como fallback, volcando lotes a disco según llegan,
+sin acumular nada en RAM.
+Configura `delay` y `max_pages` en `INPUT.json`; `delay` se interpreta
+como tasa global (1/delay peticiones por segundo).
 """
+import asyncio
+import concurrent.futures
+import csv
+import glob
 import json
 import os
 import re
-import time
-import urllib.parse
 
-import pandas as pd
-import requests
-from bs4 import BeautifulSoup
-from requests.adapters import HTTPAdapter
-from requests.exceptions import ConnectionError, HTTPError, RequestException
-from urllib3.util.retry import Retry
+import aiohttp
+import lxml.html
+from apify import Actor, Request
+from lxml import etree
+from tenacity import (retry, retry_if_exception_type, stop_after_attempt,
+                      wait_random_exponential)
 
 # Cargar configuración desde INPUT.json si existe
 input_data = {}
@@ -29,120 +40,380 @@ if os.path.exists('INPUT.json'):
 # Parámetros
 DELAY = float(input_data.get('delay', 1))
 MAX_PAGES = input_data.get('max_pages', None)
+MAX_CONNECTIONS = 10
+# Páginas de listado descargadas en paralelo por ventana
+PAGE_BATCH = 5
+# Tasa global de peticiones: `delay` pasa de pausa secuencial a req/s
+MAX_PER_SECOND = 1 / DELAY if DELAY > 0 else None
 
-# Iniciar sesión con reintentos
-
-def create_session(retries=3, backoff_factor=0.5, status_forcelist=(500,502,503,504)):
-    session = requests.Session()
-    retry = Retry(total=retries, backoff_factor=backoff_factor,
-                  status_forcelist=status_forcelist,
-                  allowed_methods=["HEAD","GET","OPTIONS"])
-    adapter = HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
-
-session = create_session()
-
-# URLs base\NLISTING_URL = (
+# URLs base
+LISTING_URL = (
     "https://www.einforma.com/rapp/resultados-busqueda/autonomos"
     "?type=AUTONOMOS&page={page}"
 )
 DETAIL_URL = "https://www.einforma.com/rapp/ficha/empresas?id={id}"
 
-# Cabeceras
-HEADERS = {"User-Agent": (
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-    "(KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
-)}
+# Cabeceras: pedimos HTML comprimido (aiohttp descomprime automáticamente)
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+        "(KHTML, like Gecko) Chrome/90.0.4430.93 Safari/537.36"
+    ),
+    "Accept-Encoding": "br, gzip",
+}
+
+# Parser HTML compartido: evita instanciar un HTMLParser por página
+_PARSER = lxml.html.HTMLParser(recover=True, huge_tree=False)
+
+# XPaths compilados una sola vez; la evaluación por página queda en C
+_XPATH_NS = {'re': 'http://exslt.org/regular-expressions'}
+
+def _field_xpath(pattern):
+    return etree.XPath(
+        "string(//strong[re:test(text(), '%s')]/following-sibling::text()[1])"
+        % pattern, namespaces=_XPATH_NS)
 
-# Realiza petición con reintentos
+FIELD_XPATHS = {
+    'name': _field_xpath(r'Denominaci[oó]n'),
+    'cif': _field_xpath(r'^CIF$'),
+    'duns': _field_xpath(r'Número\s*D-U-N-S'),
+    'cnae': _field_xpath(r'Actividad\s*CNAE'),
+    'legal_form': _field_xpath(r'Forma\s*Jur[ií]dica'),
+}
+ADDRESS_XPATH = etree.XPath(
+    "string((//strong[text()='Domicilio Social']/following::a)[1])")
+LINK_XPATH = etree.XPath("//a[contains(@href, '/rapp/ficha/empresas?id=')]/@href")
+_ID_RE = re.compile(r'[?&]id=([^&]+)')
 
-def get_with_retry(url):
+# Checkpoint de IDs ya procesados: permite reanudar tras una interrupción.
+# Se guarda en el key-value store del actor (el sistema de ficheros del
+# contenedor es efímero en la plataforma), con copia local como fallback.
+CHECKPOINT_KEY = 'DONE_IDS'
+CHECKPOINT_FILE = 'done.json'
+CHECKPOINT_EVERY = 100
+
+async def load_checkpoint():
     try:
-        resp = session.get(url, headers=HEADERS, timeout=10)
+        state = await Actor.get_value(CHECKPOINT_KEY)
+        if state:
+            return set(state)
+    except Exception:
+        print("WARNING: No se pudo leer el checkpoint del key-value store.")
+    if os.path.exists(CHECKPOINT_FILE):
+        try:
+            return set(json.load(open(CHECKPOINT_FILE, encoding='utf-8')))
+        except Exception:
+            print("WARNING: No se pudo leer el checkpoint, empezando de cero.")
+    return set()
+
+async def save_checkpoint(done):
+    ids = sorted(done)
+    await Actor.set_value(CHECKPOINT_KEY, ids)
+    tmp = CHECKPOINT_FILE + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(ids, f)
+    os.replace(tmp, CHECKPOINT_FILE)
+
+# Columnas del fichero de salida
+FIELDNAMES = ['id', 'name', 'cif', 'duns', 'cnae', 'legal_form', 'address']
+# Registros acumulados en el buffer columnar antes de volcar a disco
+BATCH_SIZE = 500
+# Registros acumulados antes de cada push al dataset de Apify
+PUSH_BATCH = 100
+
+# Vacía el buffer compartido hacia el dataset cuando alcanza PUSH_BATCH
+# (o queda algo pendiente al cerrar, con force=True)
+
+async def push_buffered(buffer, force=False):
+    if len(buffer) >= PUSH_BATCH or (force and buffer):
+        batch, buffer[:] = list(buffer), []
+        await Actor.push_data(batch)
+
+# Escritor incremental: buffer columnar (una lista por campo) que se vuelca
+# por lotes, memoria acotada por BATCH_SIZE. El Parquet se escribe en
+# partes rotadas (empresas-0000.parquet, ...): el pie de un Parquet solo
+# se escribe al cerrarlo, así que checkpoint() cierra la parte abierta y
+# todo lo confirmado queda en ficheros legibles aunque el proceso muera
+# de golpe. Al reanudar se continúa en la siguiente parte libre.
+
+PARQUET_PART = 'empresas-{:04d}.parquet'
+
+class ResultWriter:
+    def __init__(self, resume=False):
+        self._use_parquet = False
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            self._pa = pa
+            self._pq = pq
+            self._schema = pa.schema([(k, pa.string()) for k in FIELDNAMES])
+            # Partes .tmp huérfanas de una ejecución cortada: sus filas no
+            # llegaron al checkpoint y se volverán a scrapear
+            for stray in glob.glob('empresas-*.parquet.tmp'):
+                os.remove(stray)
+            self._part = 0
+            if resume:
+                while os.path.exists(PARQUET_PART.format(self._part)):
+                    self._part += 1
+            else:
+                # Ejecución desde cero: retirar partes de ejecuciones previas
+                while os.path.exists(PARQUET_PART.format(self._part)):
+                    os.remove(PARQUET_PART.format(self._part))
+                    self._part += 1
+                self._part = 0
+            self._parquet = None  # la parte se abre perezosamente en flush()
+            self._file = None
+            self._use_parquet = True
+            self.path = 'empresas-*.parquet'
+        except Exception:
+            pass
+        if not self._use_parquet:
+            new_file = not os.path.exists('empresas.csv')
+            mode = 'a' if resume else 'w'
+            self._file = open('empresas.csv', mode, newline='',
+                              encoding='utf-8')
+            self._writer = csv.writer(self._file)
+            if new_file or not resume:
+                self._writer.writerow(FIELDNAMES)
+            self.path = 'empresas.csv'
+        self._cols = {k: [] for k in FIELDNAMES}
+        self._buffered = 0
+        self.count = 0
+
+    def write(self, data):
+        for k in FIELDNAMES:
+            self._cols[k].append(data.get(k))
+        self._buffered += 1
+        if self._buffered >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self._buffered:
+            return
+        if self._use_parquet:
+            if self._parquet is None:
+                # La parte se escribe con nombre .tmp y checkpoint() la
+                # renombra al definitivo: una parte sin pie (corte antes
+                # del checkpoint) nunca queda dentro de la serie
+                self._parquet = self._pq.ParquetWriter(
+                    PARQUET_PART.format(self._part) + '.tmp', self._schema,
+                    compression='zstd')
+            # El buffer ya es columnar: la tabla Arrow se construye sin
+            # transponer nada
+            self._parquet.write_table(
+                self._pa.table(self._cols, schema=self._schema))
+        else:
+            self._writer.writerows(zip(*(self._cols[k] for k in FIELDNAMES)))
+            self._file.flush()
+        self.count += self._buffered
+        for col in self._cols.values():
+            col.clear()
+        self._buffered = 0
+
+    def checkpoint(self):
+        # Deja todo lo escrito hasta ahora legible en disco
+        self.flush()
+        if self._use_parquet and self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
+            os.replace(PARQUET_PART.format(self._part) + '.tmp',
+                       PARQUET_PART.format(self._part))
+            self._part += 1
+
+    def close(self):
+        self.checkpoint()
+        if not self._use_parquet:
+            self._file.close()
+
+# Limitador global de tasa: garantiza un intervalo mínimo entre peticiones
+# (listados y fichas comparten el mismo presupuesto de req/s)
+
+class RateLimiter:
+    def __init__(self, max_per_second):
+        self._interval = 1 / max_per_second if max_per_second else 0
+        self._next_at = 0.0
+
+    async def wait(self):
+        if not self._interval:
+            return
+        now = asyncio.get_running_loop().time()
+        delay = self._next_at - now
+        self._next_at = max(now, self._next_at) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+limiter = RateLimiter(MAX_PER_SECOND)
+
+# Realiza petición con reintentos (backoff exponencial con jitter);
+# devuelve el cuerpo. Un 429 con Retry-After espera lo que pida el servidor.
+
+@retry(retry=retry_if_exception_type((aiohttp.ClientError, asyncio.TimeoutError)),
+       wait=wait_random_exponential(multiplier=1, max=60),
+       stop=stop_after_attempt(5),
+       before_sleep=lambda rs: print(
+           f"Reintento {rs.attempt_number}: {rs.outcome.exception()}"),
+       reraise=True)
+async def get_with_retry(session, url, buf=None):
+    await limiter.wait()
+    async with session.get(url) as resp:
+        if resp.status == 429 and 'Retry-After' in resp.headers:
+            retry_after = resp.headers['Retry-After'].strip()
+            # Puede venir como fecha HTTP en vez de segundos; en ese caso
+            # dejamos la espera en manos del backoff de tenacity
+            if retry_after.isdigit():
+                await asyncio.sleep(int(retry_after))
         resp.raise_for_status()
-        return resp
-    except Exception as e:
-        print(f"Error al conectar con {url}: {e}")
-        raise
+        if buf is None:
+            return await resp.read()
+        # Streaming al buffer reutilizado del worker: evita la lista de
+        # chunks + join que resp.read() asigna en cada petición
+        buf.clear()
+        async for chunk in resp.content.iter_chunked(65536):
+            buf.extend(chunk)
+        return bytes(buf)
+
+# Productor: recorre la paginación por ventanas de PAGE_BATCH páginas en
+# paralelo y encola cada ID en la RequestQueue (el SDK deduplica por
+# unique_key, también entre ejecuciones)
 
-# Extrae IDs de la paginación
+async def _fetch_listing(session, page):
+    try:
+        return await get_with_retry(session, LISTING_URL.format(page=page))
+    except:
+        print(f"Fallo persistente en página {page}.")
+        return None
 
-def get_company_ids():
-    ids = []
+async def produce_company_ids(session, rq, done, listing_done):
+    total = 0
     page = 1
-    while True:
-        if MAX_PAGES and page > MAX_PAGES:
-            break
-        url = LISTING_URL.format(page=page)
-        try:
-            resp = get_with_retry(url)
-        except:
-            print(f"Fallo persistente en página {page}, deteniendo.")
-            break
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        links = soup.find_all('a', href=re.compile(r'/rapp/ficha/empresas\?id='))
-        if not links:
-            print(f"Sin resultados en página {page}. Fin.")
+    stop = False
+    while not stop:
+        window = [p for p in range(page, page + PAGE_BATCH)
+                  if not (MAX_PAGES and p > MAX_PAGES)]
+        if not window:
             break
-        for a in links:
-            href = a.get('href', '')
-            params = urllib.parse.parse_qs(urllib.parse.urlparse(href).query)
-            cid = params.get('id', [None])[0]
-            if cid:
-                ids.append(cid)
-        unique = set(ids)
-        print(f"Página {page}: {len(unique)} IDs únicos.")
-        page += 1
-        time.sleep(DELAY)
-    return list(set(ids))
-
-# Extrae datos de cada empresa
-
-def parse_company(cid):
+        contents = await asyncio.gather(
+            *(_fetch_listing(session, p) for p in window))
+        for p, content in zip(window, contents):
+            if content is None:
+                stop = True
+                break
+            tree = lxml.html.fromstring(content, parser=_PARSER)
+            hrefs = LINK_XPATH(tree)
+            if not hrefs:
+                print(f"Sin resultados en página {p}. Fin.")
+                stop = True
+                break
+            batch = []
+            for href in hrefs:
+                m = _ID_RE.search(href)
+                if m and m.group(1) not in done:
+                    batch.append(
+                        Request.from_url(DETAIL_URL.format(id=m.group(1)),
+                                         unique_key=m.group(1)))
+            if batch:
+                await rq.add_requests(batch)
+                total += len(batch)
+            print(f"Página {p}: {len(batch)} IDs encolados.")
+        page += PAGE_BATCH
+    listing_done.set()
+    print(f"Total IDs encolados: {total}")
+
+# Extracción pura (CPU): función de nivel de módulo para poder ejecutarla
+# en otro proceso; los XPaths compilados existen también en cada worker
+
+def _parse_detail_bytes(cid, content):
+    tree = lxml.html.fromstring(content, parser=_PARSER)
+    data = {'id': cid}
+    for field, xpath in FIELD_XPATHS.items():
+        data[field] = xpath(tree).strip() or None
+    data['address'] = ADDRESS_XPATH(tree).strip() or None
+    return data
+
+# Extrae datos de cada empresa: red en el event loop, parseo en el pool
+
+async def parse_company(session, cid, pool, buf=None):
     url = DETAIL_URL.format(id=cid)
     try:
-        resp = get_with_retry(url)
+        content = await get_with_retry(session, url, buf)
     except:
         print(f"No pudo obtener detalle {cid}.")
         return {'id': cid}
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    def get_field(pattern):
-        tag = soup.find('strong', text=re.compile(pattern))
-        return tag.next_sibling.strip() if tag and tag.next_sibling else None
-    data = {
-        'id': cid,
-        'name': get_field(r'Denominaci[oó]n'),
-        'cif': get_field(r'^CIF$'),
-        'duns': get_field(r'Número\s*D-U-N-S'),
-        'cnae': get_field(r'Actividad\s*CNAE'),
-        'legal_form': get_field(r'Forma\s*Jur[ií]dica'),
-        'address': None
-    }
-    dom = soup.find('strong', text='Domicilio Social')
-    if dom:
-        a = dom.find_next('a')
-        data['address'] = a.get_text(strip=True) if a else None
-    time.sleep(DELAY)
-    return data
+    return await asyncio.get_running_loop().run_in_executor(
+        pool, _parse_detail_bytes, cid, content)
+
+# Consumidor: drena la RequestQueue a medida que el productor encola IDs
+
+async def detail_worker(session, rq, writer, done, listing_done, pool,
+                        push_buffer):
+    # Buffer propio del worker, reutilizado para cada cuerpo de respuesta
+    buf = bytearray()
+    while True:
+        req = await rq.fetch_next_request()
+        if req is None:
+            if listing_done.is_set() and await rq.is_finished():
+                break
+            await asyncio.sleep(0.5)
+            continue
+        cid = req.unique_key
+        data = await parse_company(session, cid, pool, buf)
+        # Sin datos tras agotar reintentos: se devuelve a la cola (máx. 3)
+        if len(data) == 1 and getattr(req, 'retry_count', 0) < 3:
+            req.retry_count = getattr(req, 'retry_count', 0) + 1
+            await rq.reclaim_request(req)
+            continue
+        writer.write(data)
+        push_buffer.append(data)
+        await push_buffered(push_buffer)
+        await rq.mark_request_as_handled(req)
+        # Solo marcamos como hecho si la ficha se descargó de verdad;
+        # un registro solo-id debe reintentarse en la próxima ejecución
+        if len(data) > 1:
+            done.add(cid)
+            if len(done) % CHECKPOINT_EVERY == 0:
+                # Primero dejar en disco/dataset todo lo que el checkpoint
+                # va a dar por hecho; si no, un corte tras el guardado
+                # omitiría para siempre filas aún en los buffers
+                writer.checkpoint()
+                await push_buffered(push_buffer, force=True)
+                await save_checkpoint(done)
 
 # Flujo principal
 
-def main():
-    print(f"Delay={DELAY}s, max_pages={MAX_PAGES}")
-    ids = get_company_ids()
-    print(f"Total IDs: {len(ids)}")
-    records = [parse_company(cid) for cid in ids]
-    df = pd.DataFrame(records)
-    # Exportar
-    try:
-        with pd.ExcelWriter('empresas.xlsx', engine='xlsxwriter') as w:
-            df.to_excel(w, index=False)
-        print("Guardado empresas.xlsx")
-    except:
-        df.to_csv('empresas.csv', index=False)
-        print("Guardado empresas.csv")
+async def main():
+    async with Actor:
+        print(f"Delay={DELAY}s, max_pages={MAX_PAGES}")
+        connector = aiohttp.TCPConnector(
+            limit=100, limit_per_host=MAX_CONNECTIONS,
+            ttl_dns_cache=300, keepalive_timeout=30)
+        rq = await Actor.open_request_queue()
+        listing_done = asyncio.Event()
+        done = await load_checkpoint()
+        if done:
+            print(f"Checkpoint: {len(done)} fichas ya procesadas, se omiten.")
+        writer = ResultWriter(resume=bool(done))
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=os.cpu_count())
+        push_buffer = []
+        try:
+            async with aiohttp.ClientSession(
+                    connector=connector, headers=HEADERS,
+                    timeout=aiohttp.ClientTimeout(total=10)) as session:
+                workers = [asyncio.create_task(
+                               detail_worker(session, rq, writer, done,
+                                             listing_done, pool,
+                                             push_buffer))
+                           for _ in range(MAX_CONNECTIONS)]
+                await asyncio.gather(
+                    produce_company_ids(session, rq, done, listing_done),
+                    *workers)
+        finally:
+            await push_buffered(push_buffer, force=True)
+            pool.shutdown()
+            writer.close()
+            if done:
+                await save_checkpoint(done)
+        print(f"Guardado {writer.path} ({writer.count} registros)")
 
 if __name__=='__main__':
-    main()
+    asyncio.run(main())